@@ -1,94 +1,138 @@
 from __future__ import annotations
 
+import logging
 import os
 import string
+import sys
 from collections import Counter
-from functools import partial
+from functools import lru_cache, partial
+from pathlib import Path
+from pickle import dump, load, UnpicklingError
 from urllib.parse import urlparse
 
 import stanza
+import torch
+from filelock import FileLock
+from sortedcontainers import SortedSet
 from stanza import Pipeline
 from tqdm.contrib.concurrent import thread_map
 from urlextract import URLExtract
 
+from plagdef.config import settings
 from plagdef.model import stopwords
 from plagdef.model.models import Document, Sentence, Word
 
-PRCS = 'tokenize,mwt,pos,lemma'
+PRCS = 'tokenize,mwt,pos'
+# English has no multi-word tokens, so its pipeline skips the mwt model
+ENG_PRCS = 'tokenize,pos'
+LEMMA_PRCS = 'lemma'
 PIPE_LVL = 'WARN'
 LOAD_LVL = 'INFO'
 LANG_CODES = {'ger': 'de', 'eng': 'en'}
+MEMO_MIN_COMMON_SETS = 10
+
+log = logging.getLogger(__name__)
 
 
 class Preprocessor:
-    def __init__(self, min_sent_len: int, rem_stop_words: bool):
+    def __init__(self, min_sent_len: int, rem_stop_words: bool, tokenize_batch_size: int = None,
+                 pos_batch_size: int = None, lemma_batch_size: int = None):
         self._min_sent_len = min_sent_len
         self._rem_stop_words = rem_stop_words
+        self._tokenize_batch_size = tokenize_batch_size
+        self._pos_batch_size = pos_batch_size
+        self._lemma_batch_size = lemma_batch_size
 
     def preprocess(self, lang: str, docs: set[Document], common_docs: list[Document] = None):
-        nlp_model = _nlp_pipe(lang)
+        nlp_model = _nlp_pipe(lang, self._tokenize_batch_size, self._pos_batch_size)
         stop_words = stopwords.ENGLISH if lang == 'eng' else stopwords.GERMAN
-        common_word_lists = _common_word_lists(nlp_model, common_docs) if common_docs else []
-        thread_map(partial(self._preprocess, nlp_model=nlp_model, common_word_lists=common_word_lists,
-                           stop_words=stop_words), docs, max_workers=os.cpu_count(),
+        common_word_sets = _common_word_sets(nlp_model, common_docs) if common_docs else ()
+        docs = list(docs)
+        parsed_docs = nlp_model.bulk_process([doc.text for doc in docs])
+        _lemmatize(parsed_docs, lang, self._lemma_batch_size)
+        thread_map(partial(self._preprocess, common_word_sets=common_word_sets, stop_words=stop_words),
+                   docs, parsed_docs, max_workers=os.cpu_count(),
                    total=len(docs), desc='Preprocessing', unit='doc')
 
-    def _preprocess(self, doc: Document, nlp_model: Pipeline, common_word_lists: list[list[str]], stop_words: set[str]):
-        sents = nlp_model(doc.text).sentences
-        for sent_idx, sent in enumerate(sents):
+    def _preprocess(self, doc: Document, parsed_doc: stanza.Document, common_word_sets: tuple[frozenset[str], ...],
+                    stop_words: set[str]):
+        rem_stop_words = self._rem_stop_words
+        for sent in parsed_doc.sentences:
             filtered_words = _word_filter(sent.words)
-            if self._rem_stop_words:
+            if rem_stop_words:
                 sent_lemmas = [word.lemma for word in filtered_words if word.text.lower() not in stop_words]
             else:
                 sent_lemmas = [word.lemma for word in filtered_words]
-            if len(sent_lemmas):
+            if sent_lemmas:
                 lemma_count = Counter(sent_lemmas)
                 sentence = Sentence(sent.tokens[0].start_char, sent.tokens[-1].end_char, lemma_count, doc)
                 sentence.words = [Word(word.parent.start_char, word.parent.end_char, sentence)
                                   for word in filtered_words]
                 doc.add_sent(sentence)
-                if _sent_contains_common_words(sentence.words, common_word_lists):
+                if _sent_contains_common_words(sentence.words, common_word_sets):
                     sentence.common = True
                 else:
-                    for lemma in lemma_count.keys():
-                        doc.vocab[lemma] += 1
+                    doc.vocab.update(lemma_count.keys())
         self._join_small_sentences(doc)
         self._remove_small_sentences(doc)
         _extract_urls(doc)
 
     def _join_small_sentences(self, doc: Document):
-        sents = doc.sents(include_common=True)
-        idx, sent_count = 0, len(sents)
-        while idx < sent_count - 1:
-            sent1, sent2 = sents[idx], sents[idx + 1]
-            if (not sent1.common and not sent2.common) and \
-                (len(sent1.words) < self._min_sent_len or
-                 (sent2 == sents[-1] and len(sent2.words) < self._min_sent_len)):
-                for lemma in sent1.bow.keys():
-                    if lemma in sent2.bow:
-                        doc.vocab[lemma] -= 1
-                joined_sent = Sentence(sent1.start_char, sent2.end_char, sent1.bow + sent2.bow, doc)
-                joined_sent.words = sent1.words + sent2.words
-                doc.remove_sent(sent1), doc.remove_sent(sent2)
-                doc.add_sent(joined_sent)
-                idx -= 1
-                sent_count -= 1
-            idx += 1
+        sents = list(doc.sents(include_common=True))
+        if not sents:
+            return
+        joined_sents, current = [], sents[0]
+        for next_sent in sents[1:]:
+            if (not current.common and not next_sent.common) and \
+                (len(current.words) < self._min_sent_len or
+                 (next_sent == sents[-1] and len(next_sent.words) < self._min_sent_len)):
+                doc.vocab.subtract(current.bow.keys() & next_sent.bow.keys())
+                joined_sent = Sentence(current.start_char, next_sent.end_char, current.bow + next_sent.bow, doc)
+                joined_sent.words = current.words + next_sent.words
+                current = joined_sent
+            else:
+                joined_sents.append(current)
+                current = next_sent
+        joined_sents.append(current)
+        doc._sents = SortedSet(joined_sents)
 
     def _remove_small_sentences(self, doc: Document):
-        sents = list(doc.sents())
-        idx, sent_count = 0, len(sents)
-        while idx < sent_count:
-            if len(sents[idx].words) < self._min_sent_len:
-                for lemma in sents[idx].bow.keys():
-                    doc.vocab[lemma] -= 1
-                doc.remove_sent(sents[idx]), sents.remove(sents[idx])
-                idx -= 1
-                sent_count -= 1
-            idx += 1
+        for sent in [sent for sent in doc.sents() if len(sent.words) < self._min_sent_len]:
+            doc.vocab.subtract(sent.bow.keys())
+            doc.remove_sent(sent)
         doc.vocab += Counter()  # Remove zero counts
 
 
+class LemmaCache:
+    """Persistent dictionary lemmatizer keyed by (lowercased text, upos), grown across runs."""
+    CACHE_DIR = Path.home() / '.cache' / 'plagdef'
+
+    def __init__(self, lang: str):
+        self._file_path = LemmaCache.CACHE_DIR / f'lemma_{lang}.pkl'
+        self._lemmas = {}
+        if self._file_path.exists():
+            try:
+                with self._file_path.open('rb') as file:
+                    self._lemmas = load(file)
+            except (UnpicklingError, EOFError):
+                log.warning(f"Could not deserialize lemma cache, '{self._file_path.name}' seems to be corrupted.")
+                log.debug('Following error occurred:', exc_info=True)
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        return key in self._lemmas
+
+    def get(self, key: tuple[str, str]) -> str:
+        return self._lemmas.get(key)
+
+    def put(self, key: tuple[str, str], lemma: str):
+        self._lemmas[key] = lemma
+
+    def save(self):
+        self._file_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._file_path.open('wb') as file:
+            dump(self._lemmas, file)
+
+
 def _extract_urls(doc: Document, extractor=URLExtract()):
     extractor.update_when_older(7)
     urls = extractor.find_urls(doc.text, only_unique=True, check_dns=True)
@@ -97,39 +141,104 @@ def _extract_urls(doc: Document, extractor=URLExtract()):
         doc.urls.add(urlparse(url, "https").geturl().rstrip("/").replace("///", "//"))
 
 
-def _nlp_pipe(lang: str) -> Pipeline:
+@lru_cache(maxsize=4)
+def _nlp_pipe(lang: str, tokenize_batch_size: int = None, pos_batch_size: int = None) -> Pipeline:
+    batch_sizes = {key: size for key, size in (('tokenize_batch_size', tokenize_batch_size),
+                                               ('pos_batch_size', pos_batch_size)) if size}
+    _limit_torch_threads()
+    if lang in LANG_CODES:
+        procs = ENG_PRCS if lang == 'eng' else PRCS
+        try:
+            return stanza.Pipeline(LANG_CODES[lang], processors=procs, logging_level=PIPE_LVL,
+                                   use_gpu=settings['use_gpu'], **batch_sizes)
+        except:  # Unpickling error raises Exception, cannot narrow
+            _download(LANG_CODES[lang], procs)
+            return stanza.Pipeline(LANG_CODES[lang], processors=procs, logging_level=PIPE_LVL,
+                                   use_gpu=settings['use_gpu'], **batch_sizes)
+    else:
+        raise UnsupportedLanguageError(f'The language "{lang}" is currently not supported.')
+
+
+@lru_cache(maxsize=4)
+def _lemma_pipe(lang: str, lemma_batch_size: int = None) -> Pipeline:
+    batch_size = {'lemma_batch_size': lemma_batch_size} if lemma_batch_size else {}
+    _limit_torch_threads()
     if lang in LANG_CODES:
         try:
-            return stanza.Pipeline(LANG_CODES[lang], processors=PRCS, logging_level=PIPE_LVL)
+            return stanza.Pipeline(LANG_CODES[lang], processors=LEMMA_PRCS, logging_level=PIPE_LVL,
+                                   use_gpu=settings['use_gpu'], lemma_pretagged=True, tokenize_pretokenized=True,
+                                   **batch_size)
         except:  # Unpickling error raises Exception, cannot narrow
-            stanza.download(LANG_CODES[lang], processors=PRCS, logging_level=LOAD_LVL)
-            return stanza.Pipeline(LANG_CODES[lang], processors=PRCS, logging_level=PIPE_LVL)
+            _download(LANG_CODES[lang], LEMMA_PRCS)
+            return stanza.Pipeline(LANG_CODES[lang], processors=LEMMA_PRCS, logging_level=PIPE_LVL,
+                                   use_gpu=settings['use_gpu'], lemma_pretagged=True, tokenize_pretokenized=True,
+                                   **batch_size)
     else:
         raise UnsupportedLanguageError(f'The language "{lang}" is currently not supported.')
 
 
-def _common_word_lists(pipe: Pipeline, common_docs: list[Document]) -> list[list[str]]:
-    common_word_lists = []
-    for doc in common_docs:
-        for line in doc.text.splitlines():
-            parsed_line = pipe(line)
-            line_words = []
-            for sent in parsed_line.sentences:
-                [line_words.append(word.text.lower()) for word in _word_filter(sent.words)]
-            common_word_lists.append(line_words) if len(line_words) else None
-    return common_word_lists
+def _lemmatize(parsed_docs: list[stanza.Document], lang: str, lemma_batch_size: int = None):
+    cache = _lemma_cache(lang)
+    words = [word for parsed_doc in parsed_docs for sent in parsed_doc.sentences for word in sent.words]
+    # One representative occurrence per cache key, so repeated tokens are lemmatized only once
+    misses = {(word.text.lower(), word.upos): word.text for word in words
+              if (word.text.lower(), word.upos) not in cache}
+    if misses:
+        batch = stanza.Document([[{'id': 1, 'text': text, 'upos': upos}] for (_, upos), text in misses.items()])
+        parsed_batch = _lemma_pipe(lang, lemma_batch_size)(batch)
+        for key, parsed_word in zip(misses, (w for sent in parsed_batch.sentences for w in sent.words)):
+            cache.put(key, parsed_word.lemma)
+        cache.save()
+    for word in words:
+        lemma = cache.get((word.text.lower(), word.upos))
+        # Interning deduplicates the lemma strings, so Counter ops compare keys by identity
+        word.lemma = sys.intern(lemma) if lemma else lemma
+
+
+@lru_cache(maxsize=len(LANG_CODES))
+def _lemma_cache(lang: str) -> LemmaCache:
+    return LemmaCache(lang)
+
+
+def _download(lang_code: str, processors: str):
+    LemmaCache.CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    # Parallel processes must not race to download the same models
+    with FileLock(str(LemmaCache.CACHE_DIR / 'stanza_download.lock')):
+        stanza.download(lang_code, processors=processors, logging_level=LOAD_LVL)
+
+
+def _limit_torch_threads():
+    torch.set_num_threads(max(1, os.cpu_count() or 1))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:  # Cannot be changed after parallel work has started
+        pass
+
+
+def _common_word_sets(pipe: Pipeline, common_docs: list[Document]) -> tuple[frozenset[str], ...]:
+    lines = [line for doc in common_docs for line in doc.text.splitlines()]
+    parsed_lines = pipe.bulk_process(lines) if lines else []
+    word_sets = (frozenset(word.text.lower() for sent in parsed_line.sentences for word in _word_filter(sent.words))
+                 for parsed_line in parsed_lines)
+    # Ascending set size lets the subset checks hit the cheap candidates first
+    return tuple(sorted((word_set for word_set in word_sets if word_set), key=len))
 
 
 def _word_filter(stanza_words: list) -> list:
-    return [word for word in stanza_words if not word.upos == 'PUNCT' and word.text.isalnum() and len(word.text) > 1]
+    return [word for word in stanza_words if len(word.text) > 1 and word.text.isalnum() and word.upos != 'PUNCT']
+
+
+def _sent_contains_common_words(sent_words: list[Word], common_word_sets: tuple[frozenset[str], ...]) -> bool:
+    sent_word_texts = frozenset(word.text.lower() for word in sent_words)
+    if len(common_word_sets) > MEMO_MIN_COMMON_SETS:  # Only memoize when the hashing cost pays off
+        return _cached_contains_common_words(sent_word_texts, common_word_sets)
+    return any(common_words <= sent_word_texts for common_words in common_word_sets)
 
 
-def _sent_contains_common_words(sent_words: list[Word], common_word_lists: list[list[str]]) -> bool:
-    sent_word_texts = [word.text.lower() for word in sent_words]
-    for common_word_list in common_word_lists:
-        if all(common_word in sent_word_texts for common_word in common_word_list):
-            return True
-    return False
+@lru_cache(maxsize=100_000)
+def _cached_contains_common_words(sent_word_texts: frozenset[str], common_word_sets: tuple[frozenset[str], ...]) \
+    -> bool:
+    return any(common_words <= sent_word_texts for common_words in common_word_sets)
 
 
 class UnsupportedLanguageError(Exception):
@@ -4,30 +4,43 @@ import bz2
 import logging
 import os
 import re
-from collections import Counter
-from copy import deepcopy
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from hashlib import blake2b
 from io import BytesIO
 from json import JSONDecodeError
-from multiprocessing import Lock
+from multiprocessing import get_context
 from pathlib import Path
-from pickle import dump, load, UnpicklingError
+from pickle import dump, load, HIGHEST_PROTOCOL, UnpicklingError
+from threading import Lock
 from unicodedata import normalize
 
 import jsonpickle
 import magic
+import orjson
 import pdfplumber
+import zstandard as zstd
+
+try:  # Optional Rust reimplementation with a pdfplumber-compatible API
+    import pdfplumber_rs as fast_pdfplumber
+except ImportError:
+    fast_pdfplumber = pdfplumber
+from blake3 import blake3
 from magic import MagicException
 from ocrmypdf import ocr
-from sortedcontainers import SortedSet
-from tqdm.contrib.concurrent import process_map
+from tqdm.contrib.concurrent import thread_map
 
 from plagdef.config import settings
 from plagdef.model import models
 
 log = logging.getLogger(__name__)
-jsonpickle.set_encoder_options('json', indent=4)
+# ocrmypdf's native backend is not thread-safe
 lock = Lock()
+# libmagic is not reentrant, so the singletons are guarded by a lock
+magic_lock = Lock()
+mime_magic = magic.Magic(mime=True)
+enc_magic = magic.Magic(mime_encoding=True)
 
 
 class FileRepository:
@@ -38,23 +51,41 @@ class FileRepository:
             raise NotADirectoryError(f'The given path {base_path} does not point to an existing directory!')
 
     def list(self) -> set[models.File]:
-        files = set()
-        f_gen = self.base_path.rglob('*') if self._recursive else self.base_path.iterdir()
-        for f in f_gen:
-            if f.is_file():
-                binary = not magic.Magic(mime=True).from_buffer(open(f, 'rb').read(2048)).startswith("text")
-                try:
-                    content = f.read_bytes() if binary else self._read_text(f)
-                    files.add(models.File(f, content, binary))
-                except UnsupportedFileFormatError as e:
-                    log.error(e)
-                    log.debug('Following error occurred:', exc_info=True)
-        return files
-
-    def _read_text(self, file_path: Path):
+        file_paths = list(self._list_files())
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            files = executor.map(self._ingest_file, file_paths)
+        return set(filter(None, files))
+
+    def _list_files(self):
+        # os.scandir's dir entries cache the file type, saving a stat call per entry
+        dirs = deque([self.base_path])
+        while dirs:
+            with os.scandir(dirs.popleft()) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        yield Path(entry.path)
+                    elif self._recursive and entry.is_dir():
+                        dirs.append(entry.path)
+
+    def _ingest_file(self, file_path: Path) -> models.File:
+        with file_path.open('rb') as file:
+            head = file.read(2048)
+        with magic_lock:
+            binary = not mime_magic.from_buffer(head).startswith("text")
         try:
-            detect_enc = magic.Magic(mime_encoding=True)
-            enc = detect_enc.from_buffer(open(file_path, 'rb').read(2048))
+            content = file_path.read_bytes() if binary else self._read_text(file_path, head)
+            return models.File(file_path, content, binary)
+        except UnsupportedFileFormatError as e:
+            log.error(e)
+            log.debug('Following error occurred:', exc_info=True)
+
+    def _read_text(self, file_path: Path, head: bytes = None):
+        try:
+            if head is None:
+                with file_path.open('rb') as file:
+                    head = file.read(2048)
+            with magic_lock:
+                enc = enc_magic.from_buffer(head)
             enc_str = enc if enc != 'utf-8' else 'utf-8-sig'
             text = file_path.read_text(encoding=enc_str)
             return normalize('NFC', text)
@@ -81,19 +112,21 @@ class FileRepository:
 
 
 class DocumentFileRepository:
-    def __init__(self, dir_path: Path, recursive=False, lang=None, use_ocr=None):
+    def __init__(self, dir_path: Path, recursive=False, lang=None, use_ocr=None, workers=None):
         self._file_repo = FileRepository(dir_path, recursive)
         self.lang = lang if lang else settings['lang']
         self._use_ocr = use_ocr if use_ocr else settings['ocr']
+        self.workers = workers if workers else min(32, (os.cpu_count() or 1) * 2)
 
     @property
     def base_path(self):
         return self._file_repo.base_path
 
     def list(self) -> set[models.Document]:
-        files = list(filter(lambda f: not f.path.suffix.lower() == '.pdef', self._file_repo.list()))
-        docs = process_map(self._create_doc, files, desc=f"Reading documents in '{self.base_path}'",
-                           unit='doc', total=len(files), max_workers=os.cpu_count())
+        files = list(filter(lambda f: not f.path.name.lower().endswith(('.pdef', '.pdef.zst')),
+                            self._file_repo.list()))
+        docs = thread_map(self._create_doc, files, desc=f"Reading documents in '{self.base_path}'",
+                          unit='doc', total=len(files), max_workers=self.workers)
         return set(filter(None, docs))
 
     def _create_doc(self, file: models.File) -> models.Document:
@@ -126,70 +159,111 @@ class DocumentPairMatchesJsonRepository:
         self._out_path = out_path
 
     def save(self, doc_pair_matches):
-        clone = deepcopy(doc_pair_matches)
-        clone.doc1.vocab, clone.doc2.vocab = Counter(), Counter()
-        clone.doc1._sents, clone.doc2._sents = SortedSet(), SortedSet()
-        file_name = Path(f'{clone.doc1.name}-{clone.doc2.name}.json')
+        file_name = Path(f'{doc_pair_matches.doc1.name}-{doc_pair_matches.doc2.name}.json')
         file_path = self._out_path / file_name
-        with file_path.open('w', encoding='utf-8') as f:
-            text = jsonpickle.encode(clone)
-            f.write(text)
+        file_path.write_bytes(orjson.dumps(self._to_dict(doc_pair_matches), option=orjson.OPT_INDENT_2))
+
+    def _to_dict(self, doc_pair_matches) -> dict:
+        doc1, doc2 = doc_pair_matches.doc1, doc_pair_matches.doc2
+        return {'doc1': self._doc_to_dict(doc1), 'doc2': self._doc_to_dict(doc2),
+                'matches': {str(match_type): [[match.frag_from_doc(doc1).start_char,
+                                               match.frag_from_doc(doc1).end_char,
+                                               match.frag_from_doc(doc2).start_char,
+                                               match.frag_from_doc(doc2).end_char]
+                                              for match in doc_pair_matches.list(match_type)]
+                            for match_type in models.MatchType}}
+
+    def _doc_to_dict(self, doc: models.Document) -> dict:
+        return {'name': doc.name, 'path': doc.path, 'text': doc.text, 'urls': sorted(doc.urls)}
+
+    def _from_dict(self, payload: dict) -> models.DocumentPairMatches:
+        doc1, doc2 = self._doc_from_dict(payload['doc1']), self._doc_from_dict(payload['doc2'])
+        doc_pair_matches = models.DocumentPairMatches(doc1, doc2)
+        for type_name, frags in payload['matches'].items():
+            match_type = models.MatchType[type_name.upper()]
+            for start1, end1, start2, end2 in frags:
+                doc_pair_matches.add(models.Match(match_type, models.Fragment(start1, end1, doc1),
+                                                  models.Fragment(start2, end2, doc2)))
+        return doc_pair_matches
+
+    def _doc_from_dict(self, payload: dict) -> models.Document:
+        doc = models.Document(payload['name'], payload['path'], payload['text'])
+        doc.urls.update(payload['urls'])
+        return doc
 
     def list(self) -> set[models.DocumentPairMatches]:
-        doc_pair_matches_list = set()
-        for file in self._out_path.iterdir():
-            if file.is_file() and file.suffix == '.json':
-                try:
-                    text = file.read_text(encoding='utf-8')
-                    doc_pair_matches = jsonpickle.decode(text)
-                    doc_pair_matches_list.add(doc_pair_matches)
-                except (UnicodeDecodeError, JSONDecodeError):
-                    log.error(f"The file '{file.name}' could not be read.")
-                    log.debug('Following error occurred:', exc_info=True)
-        return doc_pair_matches_list
+        files = [f for f in self._out_path.iterdir() if f.is_file() and f.suffix == '.json']
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            doc_pair_matches = executor.map(self._read_doc_pair_matches, files)
+        return set(filter(None, doc_pair_matches))
+
+    def _read_doc_pair_matches(self, file: Path) -> models.DocumentPairMatches:
+        try:
+            data = file.read_bytes()
+            payload = orjson.loads(data)
+            if isinstance(payload, dict) and 'py/object' in payload:  # Legacy jsonpickle format
+                return jsonpickle.decode(data.decode('utf-8'))
+            return self._from_dict(payload)
+        except (UnicodeDecodeError, JSONDecodeError, KeyError, TypeError):
+            log.error(f"The file '{file.name}' could not be read.")
+            log.debug('Following error occurred:', exc_info=True)
 
 
 class DocumentPickleRepository:
     def __init__(self, dir_path: Path, common_dir_path: Path = None):
         if not dir_path.is_dir():
             raise NotADirectoryError(f"The given path '{dir_path}' does not point to an existing directory!")
-        path_hash = blake2b(str(common_dir_path).encode(), digest_size=16).hexdigest()
-        self.file_path = dir_path / f'.{path_hash}.pdef'
+        path_hash = blake3(str(common_dir_path).encode()).hexdigest(length=16)
+        self.file_path = dir_path / f'.{path_hash}.pdef.zst'
+        # Pre-zstd releases named the cache with a blake2b digest
+        legacy_hash = blake2b(str(common_dir_path).encode(), digest_size=16).hexdigest()
+        self._legacy_file_path = dir_path / f'.{legacy_hash}.pdef'
 
     def save(self, docs: set[models.Document]):
-        with bz2.open(self.file_path, 'wb') as file:
-            dump(docs, file)
+        with self.file_path.open('wb') as raw_file, \
+            zstd.ZstdCompressor(level=3, threads=-1).stream_writer(raw_file) as file:
+            dump(docs, file, protocol=HIGHEST_PROTOCOL)
 
     def list(self) -> set[models.Document]:
         if self.file_path.exists():
             log.info('Found preprocessing file. Deserializing...')
             try:
-                with bz2.open(self.file_path, 'rb') as file:
+                with self.file_path.open('rb') as raw_file, zstd.ZstdDecompressor().stream_reader(raw_file) as file:
                     return load(file)
-            except (UnpicklingError, EOFError):
+            except (UnpicklingError, EOFError, zstd.ZstdError):
                 log.warning(f"Could not deserialize preprocessing file, '{self.file_path.name}' seems to be corrupted.")
                 log.debug('Following error occurred:', exc_info=True)
+        elif self._legacy_file_path.exists():
+            log.info('Found legacy preprocessing file. Deserializing...')
+            try:
+                with bz2.open(self._legacy_file_path, 'rb') as file:
+                    return load(file)
+            except (UnpicklingError, EOFError, OSError):  # bz2 reports corrupt streams with OSError
+                log.warning(
+                    f"Could not deserialize preprocessing file, '{self._legacy_file_path.name}' seems to be corrupted.")
+                log.debug('Following error occurred:', exc_info=True)
         return set()
 
 
 class PdfReader:
-    ERROR_HEURISTIC = '¨[aou]|ﬀ|\(cid:\d+\)|[a-zA-Z]{50}'
+    ERROR_HEURISTIC = re.compile(r'¨[aou]|ﬀ|\(cid:\d+\)|[a-zA-Z]{50}')
+    HYPHENATION = re.compile(r'-\s?\n')
 
     def __init__(self, file, lang, use_ocr):
         self._file = file
         self._lang = lang if lang == 'eng' else 'deu'
         self._use_ocr = use_ocr
+        self._parsed = None
 
     def extract_urls(self):
         # Temporary fix for: https://github.com/jsvine/pdfplumber/issues/463
         try:
-            with pdfplumber.open(self._file) as pdf:
-                return {uri_obj['uri'].rstrip('/') for uri_obj in pdf.hyperlinks}
+            return self._parse()[1]
         except UnicodeDecodeError:
             log.warning(f'Could not extract hyperlinks from PDF "{self._file.name}".')
 
     def extract_text(self):
-        text = self._extract()
+        text = self._parse()[0]
         if self._use_ocr and self._poor_extraction(text):
             log.warning(f"Poor text extraction in '{self._file.name}' detected! Using OCR...")
             with BytesIO() as ocr_file:
@@ -199,16 +273,58 @@ class PdfReader:
                 text = self._extract(ocr_file)
         return text
 
+    def _parse(self) -> tuple[str, set]:
+        if self._parsed is None:
+            with pdfplumber.open(self._file) as pdf:
+                try:
+                    urls = {uri_obj['uri'].rstrip('/') for uri_obj in pdf.hyperlinks}
+                except UnicodeDecodeError:
+                    log.warning(f'Could not extract hyperlinks from PDF "{self._file.name}".')
+                    urls = None
+                text = self._extract_from(pdf, self._file)
+            self._parsed = text, urls
+        return self._parsed
+
     def _extract(self, file=None) -> str:
         if file is None:
             file = self._file
-        with pdfplumber.open(file) as pdf:
+        with fast_pdfplumber.open(file) as pdf:
+            return self._extract_from(pdf, file)
+
+    def _extract_from(self, pdf, file) -> str:
+        page_count = len(pdf.pages)
+        if page_count <= settings['pdf_serial_max_pages']:
             text = ' '.join(filter(None, (page.extract_text() for page in pdf.pages)))
-            normalized_text = normalize('NFC', text)
-            return re.sub('-\s?\n', '', normalized_text)  # Merge hyphenated words
+        else:
+            text = _extract_pages_parallel(file, page_count)
+        normalized_text = normalize('NFC', text)
+        return PdfReader.HYPHENATION.sub('', normalized_text)  # Merge hyphenated words
 
     def _poor_extraction(self, text: str) -> bool:
-        return not len(text.strip()) or bool(re.search(PdfReader.ERROR_HEURISTIC, text))
+        return not len(text.strip()) or bool(PdfReader.ERROR_HEURISTIC.search(text))
+
+
+def _extract_pages_parallel(file, page_count: int) -> str:
+    source = file.getvalue() if isinstance(file, BytesIO) else file
+    threaded = page_count <= settings['pdf_thread_max_pages'] or isinstance(source, bytes)
+    workers = os.cpu_count() or 1
+    chunk_size = -(-page_count // workers) if threaded else settings['pdf_thread_max_pages']
+    page_ranges = [(start, min(start + chunk_size, page_count)) for start in range(0, page_count, chunk_size)]
+    if threaded:
+        executor = ThreadPoolExecutor(max_workers=min(workers, len(page_ranges)))
+    else:
+        # Spawn fresh workers, as forking the threaded ingest could inherit held locks
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(page_ranges)), mp_context=get_context('spawn'))
+    with executor as pool:
+        texts = pool.map(partial(_extract_page_range, source), page_ranges)
+    return ' '.join(filter(None, texts))
+
+
+def _extract_page_range(source, page_range: tuple[int, int]) -> str:
+    # Pages are independent, but the underlying stream is not thread-safe, so each worker opens its own session
+    file = BytesIO(source) if isinstance(source, bytes) else source
+    with fast_pdfplumber.open(file) as pdf:
+        return ' '.join(filter(None, (pdf.pages[idx].extract_text() for idx in range(*page_range))))
 
 
 class UnsupportedFileFormatError(Exception):
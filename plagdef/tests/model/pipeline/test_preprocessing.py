@@ -2,8 +2,8 @@ from collections import Counter
 
 import pytest
 
-from plagdef.model.pipeline.preprocessing import UnsupportedLanguageError, Document, Preprocessor, _nlp_pipe, \
-    _extract_urls
+from plagdef.model.pipeline.preprocessing import LemmaCache, UnsupportedLanguageError, Document, Preprocessor, \
+    _nlp_pipe, _extract_urls
 
 
 def test_nlp_model():
@@ -318,3 +318,37 @@ def test_extract_url_rstrips_punctuation():
                    "https://www.weltderphysik.de/gebiet/teilchen/antimaterie/antimaterie-im-universum/,")
     _extract_urls(doc)
     assert doc.urls == {'https://www.weltderphysik.de/gebiet/teilchen/antimaterie/antimaterie-im-universum'}
+
+
+def test_lemma_cache_save_and_reload(tmp_path, monkeypatch):
+    monkeypatch.setattr(LemmaCache, 'CACHE_DIR', tmp_path)
+    cache = LemmaCache('eng')
+    cache.put(('words', 'NOUN'), 'word')
+    cache.save()
+    reloaded_cache = LemmaCache('eng')
+    assert ('words', 'NOUN') in reloaded_cache
+    assert reloaded_cache.get(('words', 'NOUN')) == 'word'
+
+
+def test_lemma_cache_is_separated_by_lang(tmp_path, monkeypatch):
+    monkeypatch.setattr(LemmaCache, 'CACHE_DIR', tmp_path)
+    cache = LemmaCache('eng')
+    cache.put(('words', 'NOUN'), 'word')
+    cache.save()
+    other_cache = LemmaCache('ger')
+    assert ('words', 'NOUN') not in other_cache
+
+
+def test_lemma_cache_file_exists_with_corrupt_content(tmp_path, monkeypatch):
+    monkeypatch.setattr(LemmaCache, 'CACHE_DIR', tmp_path)
+    with (tmp_path / 'lemma_eng.pkl').open('w', encoding='utf-8') as f:
+        f.write('Invalid content.')
+    cache = LemmaCache('eng')
+    assert ('words', 'NOUN') not in cache
+
+
+def test_lemma_cache_file_exists_with_no_content(tmp_path, monkeypatch):
+    monkeypatch.setattr(LemmaCache, 'CACHE_DIR', tmp_path)
+    (tmp_path / 'lemma_eng.pkl').touch()
+    cache = LemmaCache('eng')
+    assert ('words', 'NOUN') not in cache
@@ -133,6 +133,18 @@ def test_pdf_reader_merges_hyphenated_words_at_line_end(tmp_path):
                    ' which split words.'
 
 
+def test_pdf_reader_extracts_pages_of_large_pdf_in_order(tmp_path):
+    doc1 = FPDF()
+    doc1.set_font('helvetica', size=12)
+    for page_num in range(15):  # More than pdf_serial_max_pages, so pages are extracted in parallel
+        doc1.add_page()
+        doc1.cell(w=0, txt=f'This is page {page_num}.')
+    doc1.output(f'{tmp_path}/doc1.pdf')
+    reader = PdfReader(tmp_path / 'doc1.pdf', lang='eng', use_ocr=False)
+    text = reader.extract_text()
+    assert text == ' '.join(f'This is page {page_num}.' for page_num in range(15))
+
+
 @patch("pdfplumber.open", side_effect=UnicodeDecodeError("", bytes(), -1, -1, ""))
 def test_pdf_reader_extract_urls_returns_none_on_unicode_decode_error(pdf_mock, tmp_path):
     reader = PdfReader(tmp_path, lang='eng', use_ocr=True)
@@ -1,7 +1,9 @@
 from pathlib import Path
 
+import jsonpickle
 import pytest
 
+from plagdef.model.models import MatchType
 from plagdef.repositories import DocumentPairMatchesJsonRepository
 
 
@@ -25,6 +27,30 @@ def test_save_doc_pair_matches(tmp_path, matches):
     assert doc_pair_matches == matches
 
 
+def test_save_doc_pair_matches_preserves_match_fragments(tmp_path, matches):
+    repo = DocumentPairMatchesJsonRepository(tmp_path)
+    [repo.save(m) for m in matches]
+    doc_pair_matches = repo.list()
+    # DocumentPairMatches.__eq__ only compares the document pair, so check the matches themselves
+    for saved in matches:
+        deserialized = next(m for m in doc_pair_matches if m == saved)
+        for match_type in MatchType:
+            assert deserialized.list(match_type) == saved.list(match_type)
+
+
+def test_file_exists_with_legacy_jsonpickle_format(tmp_path, matches):
+    saved = next(iter(matches))
+    file_path = tmp_path / f'{saved.doc1.name}-{saved.doc2.name}.json'
+    with file_path.open('w', encoding='utf-8') as f:
+        f.write(jsonpickle.encode(saved))
+    repo = DocumentPairMatchesJsonRepository(tmp_path)
+    doc_pair_matches = repo.list()
+    assert doc_pair_matches == {saved}
+    deserialized = next(iter(doc_pair_matches))
+    for match_type in MatchType:
+        assert deserialized.list(match_type) == saved.list(match_type)
+
+
 def test_list_if_no_file_exists(tmp_path):
     serializer = DocumentPairMatchesJsonRepository(tmp_path)
     empty = serializer.list()
@@ -1,5 +1,5 @@
+import bz2
 from collections import Counter
-from ctypes import c_size_t
 from pathlib import Path
 from pickle import dump, load
 
@@ -51,22 +51,37 @@ def test_init_with_file_fails(tmp_path):
 
 
 def test_file_exists_with_corrupt_content(tmp_path):
-    file_path = tmp_path / f'.{c_size_t(hash(None)).value}.pdef'
-    with file_path.open('w', encoding='utf-8') as f:
-        f.write('Invalid content.')
     ser = DocumentPickleRepository(tmp_path)
+    with ser.file_path.open('w', encoding='utf-8') as f:
+        f.write('Invalid content.')
     docs = ser.list()
     assert docs == set()
 
 
 def test_file_exists_with_no_content(tmp_path):
-    file_path = tmp_path / f'.{c_size_t(hash(None)).value}.pdef'
-    file_path.touch()
     ser = DocumentPickleRepository(tmp_path)
+    ser.file_path.touch()
+    docs = ser.list()
+    assert docs == set()
+
+
+def test_legacy_file_exists_with_corrupt_content(tmp_path):
+    ser = DocumentPickleRepository(tmp_path)
+    with ser._legacy_file_path.open('w', encoding='utf-8') as f:
+        f.write('Invalid content.')
     docs = ser.list()
     assert docs == set()
 
 
+def test_deserialize_from_legacy_bz2_file(tmp_path):
+    docs = {Document('doc1', 'path/to/doc1', 'Some text.'), Document('doc2', 'path/to/doc2', 'Different text.')}
+    ser = DocumentPickleRepository(tmp_path)
+    with bz2.open(ser._legacy_file_path, 'wb') as file:
+        dump(docs, file)
+    deserialized_docs = ser.list()
+    assert deserialized_docs == docs
+
+
 def test_pickle_fragment(tmp_path):
     frag = Fragment(0, 1, Document('doc', 'path/to/doc', 'Content.'))
     with (tmp_path / 'pickle.dat').open('wb') as file: